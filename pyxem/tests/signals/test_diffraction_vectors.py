@@ -30,65 +30,53 @@ from pyxem.signals import DiffractionVectors, DiffractionVectors2D, DiffractionV
 # these cases and all methods tested for it.
 
 
-@pytest.fixture(
-    params=[
-        np.array(
-            [
-                [
-                    np.array(
-                        [
-                            [0.089685, 0.292971],
-                            [0.017937, 0.277027],
-                            [-0.069755, 0.257097],
-                            [-0.165419, 0.241153],
-                            [0.049825, 0.149475],
-                            [-0.037867, 0.129545],
-                            [-0.117587, 0.113601],
-                        ]
-                    ),
-                    np.array(
-                        [
-                            [0.089685, 0.292971],
-                            [0.017937, 0.277027],
-                            [-0.069755, 0.257097],
-                            [-0.165419, 0.241153],
-                            [0.049825, 0.149475],
-                            [-0.037867, 0.129545],
-                            [-0.117587, 0.113601],
-                            [0.149475, 0.065769],
-                            [0.229195, 0.045839],
-                            [0.141503, 0.025909],
-                            [0.073741, 0.013951],
-                            [0.001993, 0.001993],
-                            [-0.069755, -0.009965],
-                        ]
-                    ),
-                ],
-                [
-                    np.array(
-                        [
-                            [0.089685, 0.292971],
-                            [0.017937, 0.277027],
-                            [-0.069755, 0.257097],
-                            [-0.165419, 0.241153],
-                            [0.049825, 0.149475],
-                            [-0.037867, 0.129545],
-                            [-0.117587, 0.113601],
-                            [0.149475, 0.065769],
-                            [0.229195, 0.045839],
-                            [0.141503, 0.025909],
-                            [0.073741, 0.013951],
-                        ]
-                    ),
-                    np.array([[0.001993, 0.001993]]),
-                ],
-            ],
-            dtype=object,
-        )
+# Vectors of the 2x2 ragged map, stored flat. The vectors at the i-th
+# (flattened) navigation position are _FLAT[_OFFSETS[i]:_OFFSETS[i + 1]].
+_FLAT = np.array(
+    [
+        [0.089685, 0.292971],
+        [0.017937, 0.277027],
+        [-0.069755, 0.257097],
+        [-0.165419, 0.241153],
+        [0.049825, 0.149475],
+        [-0.037867, 0.129545],
+        [-0.117587, 0.113601],
+        [0.089685, 0.292971],
+        [0.017937, 0.277027],
+        [-0.069755, 0.257097],
+        [-0.165419, 0.241153],
+        [0.049825, 0.149475],
+        [-0.037867, 0.129545],
+        [-0.117587, 0.113601],
+        [0.149475, 0.065769],
+        [0.229195, 0.045839],
+        [0.141503, 0.025909],
+        [0.073741, 0.013951],
+        [0.001993, 0.001993],
+        [-0.069755, -0.009965],
+        [0.089685, 0.292971],
+        [0.017937, 0.277027],
+        [-0.069755, 0.257097],
+        [-0.165419, 0.241153],
+        [0.049825, 0.149475],
+        [-0.037867, 0.129545],
+        [-0.117587, 0.113601],
+        [0.149475, 0.065769],
+        [0.229195, 0.045839],
+        [0.141503, 0.025909],
+        [0.073741, 0.013951],
+        [0.001993, 0.001993],
     ]
 )
-def diffraction_vectors_map(request):
-    dvm = DiffractionVectors(request.param)
+_OFFSETS = np.array([0, 7, 20, 31, 32])
+
+
+@pytest.fixture
+def diffraction_vectors_map():
+    data = np.empty((2, 2), dtype=object)
+    for i, (start, stop) in enumerate(zip(_OFFSETS[:-1], _OFFSETS[1:])):
+        data.flat[i] = _FLAT[start:stop].copy()
+    dvm = DiffractionVectors(data)
     dvm.axes_manager[0].name = "x"
     dvm.axes_manager[1].name = "y"
     return dvm
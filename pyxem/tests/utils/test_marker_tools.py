@@ -16,6 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with pyXem.  If not, see <http://www.gnu.org/licenses/>.
 
+import gc
+
 import pytest
 import numpy as np
 from numpy.testing import assert_equal
@@ -112,6 +114,84 @@ class TestGet4DMarkerList:
         )
         assert len(marker_list) == 2
 
+    def test_none_and_outside_peaks(self):
+        peak_array = np.empty((2, 3), dtype=object)
+        peak_array[0, 0] = [[2, 4], [1, 19]]
+        peak_array[1, 2] = [[6, 3]]
+        s = Diffraction2D(np.zeros(shape=(2, 3, 10, 10)))
+        s.axes_manager.signal_axes[0].scale = 0.5
+        s.axes_manager.signal_axes[1].offset = 3
+        marker_list = mt._get_4d_points_marker_list(
+            peak_array, s.axes_manager.signal_axes
+        )
+        assert len(marker_list) == 2
+        x0, y0 = marker_list[0].data["x1"][()], marker_list[0].data["y1"][()]
+        x1, y1 = marker_list[1].data["x1"][()], marker_list[1].data["y1"][()]
+        assert_equal(x0, [[2.0, -1000, -1000], [-1000, -1000, 1.5]])
+        assert_equal(y0, [[5.0, -1000, -1000], [-1000, -1000, 9.0]])
+        assert_equal(x1, -1000 * np.ones((2, 3)))
+        assert_equal(y1, -1000 * np.ones((2, 3)))
+
+    def test_no_signal_axes(self):
+        peak_array = np.random.randint(99, size=(2, 3, 4, 2))
+        marker_list = mt._get_4d_points_marker_list(peak_array)
+        assert len(marker_list) == 4
+        for i_p, marker in enumerate(marker_list):
+            assert_equal(marker.data["x1"][()], peak_array[:, :, i_p, 1])
+            assert_equal(marker.data["y1"][()], peak_array[:, :, i_p, 0])
+
+
+class TestMarkerPositionCache:
+    def test_cache_hit(self):
+        peak_array = np.random.randint(10, size=(2, 3, 4, 2))
+        s = Diffraction2D(np.zeros(shape=(2, 3, 10, 10)))
+        signal_axes = s.axes_manager.signal_axes
+        x0, y0 = mt._get_cached_marker_position_arrays(peak_array, signal_axes)
+        x1, y1 = mt._get_cached_marker_position_arrays(peak_array, signal_axes)
+        assert_equal(x0, x1)
+        assert_equal(y0, y1)
+        assert x0 is not x1
+        x1[:] = 0
+        x2, _ = mt._get_cached_marker_position_arrays(peak_array, signal_axes)
+        assert_equal(x0, x2)
+
+    def test_cache_axes_changed(self):
+        peak_array = np.random.randint(10, size=(2, 3, 4, 2))
+        s = Diffraction2D(np.zeros(shape=(2, 3, 10, 10)))
+        signal_axes = s.axes_manager.signal_axes
+        x0, _ = mt._get_cached_marker_position_arrays(peak_array, signal_axes)
+        signal_axes[0].scale = 0.5
+        x1, _ = mt._get_cached_marker_position_arrays(peak_array, signal_axes)
+        assert_equal(x1, x0 * 0.5)
+
+    def test_cache_size(self):
+        s = Diffraction2D(np.zeros(shape=(2, 3, 10, 10)))
+        peak_arrays = [np.zeros((2, 3, 1, 2)) for i in range(20)]
+        for peak_array in peak_arrays:
+            mt._get_4d_points_marker_list(
+                peak_array, s.axes_manager.signal_axes, cache=True
+            )
+        assert len(mt._MARKER_CACHE) <= mt._MARKER_CACHE_SIZE
+
+    def test_cache_opt_in(self):
+        mt._MARKER_CACHE.clear()
+        s = Diffraction2D(np.zeros(shape=(2, 3, 10, 10)))
+        peak_array = np.random.randint(10, size=(2, 3, 4, 2))
+        mt.add_peak_array_to_signal_as_markers(s, peak_array)
+        assert len(mt._MARKER_CACHE) == 0
+        mt.add_peak_array_to_signal_as_markers(s, peak_array, cache=True)
+        assert len(mt._MARKER_CACHE) == 1
+
+    def test_cache_entry_dropped(self):
+        mt._MARKER_CACHE.clear()
+        s = Diffraction2D(np.zeros(shape=(2, 3, 10, 10)))
+        peak_array = np.random.randint(10, size=(2, 3, 4, 2))
+        mt._get_cached_marker_position_arrays(peak_array, s.axes_manager.signal_axes)
+        assert len(mt._MARKER_CACHE) == 1
+        del peak_array
+        gc.collect()
+        assert len(mt._MARKER_CACHE) == 0
+
 
 class TestFilterPeakArrayListBoolArray:
     def test_wrong_size_input(self):
@@ -171,6 +251,16 @@ class TestAddPeakArrayToSignalAsMarkers:
         marker = list(s.metadata.Markers)[0][1]
         assert marker.get_data_position("size") == size
 
+    def test_add_twice(self):
+        peak_array = np.zeros(shape=(3, 2, 3, 2))
+        s = Diffraction2D(np.zeros(shape=(3, 2, 10, 10)))
+        mt.add_peak_array_to_signal_as_markers(s, peak_array, color="red")
+        mt.add_peak_array_to_signal_as_markers(s, peak_array, color="blue")
+        markers = s.metadata.Markers
+        assert markers.keys() == ["marker{0}".format(i) for i in range(6)]
+        assert markers.marker2.marker_properties["color"] == "red"
+        assert markers.marker3.marker_properties["color"] == "blue"
+
     def test_dask_input(self):
         s = Diffraction2D(np.zeros((2, 3, 20, 20)))
         peak_array = da.zeros((2, 3, 10, 2), chunks=(1, 1, 10, 2))
@@ -210,6 +300,55 @@ class TestPixelToScaledValue:
         assert value == 8.25
 
 
+class TestGet4DLineSegmentList:
+    def test_scaled_signal_axes(self):
+        lines_array = np.empty((2, 3), dtype=object)
+        lines_array[0, 0] = [[10, 20, 30, 40], [10, 20, 30, 60]]
+        lines_array[1, 2] = [[4, 2, 8, 6]]
+        s = Diffraction2D(np.zeros((2, 3, 50, 50), dtype=np.uint16))
+        signal_axes = s.axes_manager.signal_axes
+        signal_axes[0].scale, signal_axes[0].offset = 0.5, -2
+        signal_axes[1].scale, signal_axes[1].offset = 2, 1
+        marker_list = mt._get_4d_line_segment_list(lines_array, signal_axes)
+        assert len(marker_list) == 2
+        marker = marker_list[0]
+        assert marker.data["x1"][()][0, 0] == 8.0
+        assert marker.data["y1"][()][0, 0] == 21.0
+        assert marker.data["x2"][()][0, 0] == 18.0
+        assert marker.data["y2"][()][0, 0] == 61.0
+        assert marker.data["x1"][()][1, 2] == -1.0
+        assert marker.data["y2"][()][1, 2] == 17.0
+        assert marker.data["x1"][()][0, 1] == -1000
+        assert (marker_list[1].data["x1"][()] == -1000).all()
+
+    def test_non_uniform_signal_axes(self):
+        lines_array = np.empty((2, 3), dtype=object)
+        lines_array[0, 0] = [[10, 20, 30, 40]]
+        s = Diffraction2D(np.zeros((2, 3, 50, 50), dtype=np.uint16))
+        signal_axes = s.axes_manager.signal_axes
+        signal_axes[0].convert_to_non_uniform_axis()
+        signal_axes[0].axis = np.arange(50.0) ** 2
+        signal_axes[1].scale = 2
+        marker_list = mt._get_4d_line_segment_list(lines_array, signal_axes)
+        marker = marker_list[0]
+        assert marker.data["x1"][()][0, 0] == 400.0
+        assert marker.data["y1"][()][0, 0] == 20.0
+        assert marker.data["x2"][()][0, 0] == 1600.0
+        assert marker.data["y2"][()][0, 0] == 60.0
+
+    def test_numeric_lines_array(self):
+        lines_array = np.zeros((2, 3, 2, 4))
+        lines_array[..., 0, :] = [10, 20, 30, 40]
+        lines_array[..., 1, :] = [4, 2, 8, 6]
+        s = Diffraction2D(np.zeros((2, 3, 50, 50), dtype=np.uint16))
+        signal_axes = s.axes_manager.signal_axes
+        marker_list = mt._get_4d_line_segment_list(lines_array, signal_axes)
+        assert len(marker_list) == 2
+        assert (marker_list[0].data["x1"][()] == 20).all()
+        assert (marker_list[0].data["y2"][()] == 30).all()
+        assert (marker_list[1].data["x2"][()] == 6).all()
+
+
 class TestCheckLineSegmentInside:
     @pytest.mark.parametrize(
         "line",
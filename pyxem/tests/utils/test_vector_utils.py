@@ -25,9 +25,14 @@ from pyxem.utils.vector_utils import calculate_norms
 from pyxem.utils.vector_utils import calculate_norms_ragged
 from pyxem.utils.vector_utils import detector_to_fourier
 from pyxem.utils.vector_utils import get_rotation_matrix_between_vectors
+from pyxem.utils.vector_utils import normalize_or_zero
 from pyxem.utils.vector_utils import get_angle_cartesian
 from pyxem.utils.vector_utils import get_angle_cartesian_vec
 from pyxem.utils.vector_utils import filter_vectors_near_basis
+from pyxem.utils.vector_utils import filter_vectors_ragged
+from pyxem.utils.vector_utils import filter_vectors_edge_ragged
+from pyxem.utils.vector_utils import ragged_to_csr
+from pyxem.utils.vector_utils import csr_to_ragged
 
 
 def test_calculate_norms():
@@ -35,11 +40,27 @@ def test_calculate_norms():
     assert np.allclose(norms, [5, 10])
 
 
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_calculate_norms_dtype(dtype):
+    norms = calculate_norms(np.array([[3, 4], [6, 8]], dtype=dtype))
+    assert norms.dtype == dtype
+    np.testing.assert_allclose(norms, [5, 10])
+
+
 def test_calculate_norms_ragged():
     norms = calculate_norms_ragged(np.array([[3], [6, 8]], dtype=object))
     assert np.allclose(norms, [3, 10])
 
 
+def test_calculate_norms_ragged_array():
+    norms = calculate_norms_ragged(np.array([[3, 4], [6, 8], [0, 0]]))
+    assert np.allclose(norms, [5, 10, 0])
+    norms = calculate_norms_ragged(np.array([[], [6, 8], [1]], dtype=object))
+    assert np.allclose(norms, [0, 10, 1])
+    norms = calculate_norms_ragged(np.empty((0, 2)))
+    assert norms.shape == (0,)
+
+
 @pytest.mark.parametrize(
     "wavelength, camera_length, detector_coords, k_expected",
     [
@@ -62,6 +83,15 @@ def test_detector_to_fourier(wavelength, camera_length, detector_coords, k_expec
     np.testing.assert_allclose(k, k_expected)
 
 
+def test_normalize_or_zero():
+    v = np.array([[3.0, 0.0, 4.0], [0.0, 0.0, 0.0], [0.0, -2.0, 0.0]])
+    normalize_or_zero(v)
+    np.testing.assert_allclose(v, [[0.6, 0, 0.8], [0, 0, 0], [0, -1, 0]])
+    v = np.array([0.0, 5.0, 0.0])
+    normalize_or_zero(v)
+    np.testing.assert_allclose(v, [0, 1, 0])
+
+
 @pytest.mark.parametrize(
     "from_v1, from_v2, to_v1, to_v2, expected_rotation",
     [
@@ -118,7 +148,12 @@ def test_get_angle_cartesian(vec_a, vec_b, expected_angle):
             np.array([[0, 0, 1], [0, 0, 0]]),
             np.array([[0, 1, 0], [0, 0, 1]]),
             [np.deg2rad(90), 0],
-        )
+        ),
+        (
+            np.array([[1.0, 0.0, 0.0], [0.0, 0.0, 3.0], [0.0, 0.0, 0.0]]),
+            np.array([[2.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 0.0, 0.0]]),
+            [0, np.pi, 0],
+        ),
     ],
 )
 def test_get_angle_cartesian_vec(a, b, expected_angles):
@@ -147,9 +182,97 @@ def test_filter_near_basis():
     np.testing.assert_array_equal(is_nan, dist > 0.4)
 
 
+@pytest.mark.parametrize("distance", [None, 0.4])
+def test_filter_near_basis_large(distance):
+    rng = np.random.default_rng(0)
+    # Basis points are more than 12 apart, and shifted by less than 1.5
+    basis_vectors = np.arange(100)[:, np.newaxis] * [10, 7]
+    shifts = rng.random((100, 2))
+    distractors = rng.random((100, 2)) * [1000, 700]
+    to_basis = np.linalg.norm(distractors[:, None] - basis_vectors, axis=-1)
+    distractors = distractors[to_basis.min(axis=1) > 2]
+    vectors = np.vstack([basis_vectors + shifts, distractors])
+    filt = filter_vectors_near_basis(vectors, basis_vectors, distance=distance)
+    dist = np.linalg.norm(shifts, axis=1)
+    if distance is None:
+        not_nearest = np.linalg.norm(filt - basis_vectors, axis=1) > dist + 1e-9
+        assert not np.any(not_nearest)
+    else:
+        is_nan = np.isnan(filt).sum(axis=1) > 0
+        np.testing.assert_array_equal(is_nan, dist > distance)
+        np.testing.assert_allclose(filt[~is_nan], vectors[:100][~is_nan])
+
+
 def test_basis_filter_no_vectors():
     basis_vectors = np.random.randint(0, 100, (10, 2))
     vectors = np.empty((0, 2))
     filt = filter_vectors_near_basis(vectors, basis_vectors, distance=0.4)
     is_nan = np.isnan(filt).sum(axis=1) > 0
     np.testing.assert_array_equal(is_nan, True)
+
+
+@pytest.fixture
+def ragged_vectors():
+    vectors = np.empty((2, 2), dtype=object)
+    vectors[0, 0] = np.array([[3.0, 4.0], [0.5, 0.5]])
+    vectors[0, 1] = np.empty((0, 2))
+    vectors[1, 1] = np.array([[6.0, -1.0], [1.0, 2.0], [-2.0, 1.0]])
+    return vectors
+
+
+def test_ragged_to_csr(ragged_vectors):
+    flat, offsets = ragged_to_csr(ragged_vectors)
+    assert flat.shape == (5, 2)
+    np.testing.assert_array_equal(offsets, [0, 2, 2, 2, 5])
+    vectors = csr_to_ragged(flat, offsets, shape=(2, 2))
+    assert vectors.shape == (2, 2)
+    for index in np.ndindex(vectors.shape):
+        expected = ragged_vectors[index]
+        if expected is None:
+            expected = np.empty((0, 2))
+        np.testing.assert_array_equal(vectors[index], expected)
+
+
+def test_ragged_to_csr_empty():
+    vectors = np.empty(3, dtype=object)
+    vectors[0] = np.empty((0, 3))
+    flat, offsets = ragged_to_csr(vectors)
+    assert flat.shape == (0, 3)
+    np.testing.assert_array_equal(offsets, [0, 0, 0, 0])
+    assert csr_to_ragged(flat, offsets)[0].shape == (0, 3)
+
+
+def test_filter_vectors_ragged():
+    z = np.array([[3.0, 4.0], [0.0, 0.0], [6.0, 8.0], [0.0, 1.0]])
+    filtered = filter_vectors_ragged(z, 0, 5)
+    np.testing.assert_array_equal(filtered, [[3, 4], [0, 0], [0, 1]])
+    filtered = filter_vectors_ragged(z, 1, 10)
+    np.testing.assert_array_equal(filtered, [[3, 4], [6, 8], [0, 1]])
+    filtered = filter_vectors_ragged(z, -1, 5)
+    np.testing.assert_array_equal(filtered, [[3, 4], [0, 0], [0, 1]])
+    filtered = filter_vectors_ragged(z, -np.inf, np.inf)
+    np.testing.assert_array_equal(filtered, z)
+    assert len(filter_vectors_ragged(z, -np.inf, -1)) == 0
+    assert filter_vectors_ragged(np.empty((0,)), 0, 1).shape == (0,)
+    np.testing.assert_array_equal(z[1], [0, 0])
+
+
+def test_filter_vectors_ragged_csr(ragged_vectors):
+    flat, offsets = ragged_to_csr(ragged_vectors)
+    filtered, filtered_offsets = filter_vectors_ragged(flat, 1, 5, offsets=offsets)
+    np.testing.assert_array_equal(filtered, [[3, 4], [1, 2], [-2, 1]])
+    np.testing.assert_array_equal(filtered_offsets, [0, 1, 1, 1, 3])
+
+
+def test_filter_vectors_edge_ragged():
+    z = np.array([[0.0, 1.0], [-3.0, 0.5], [1.0, -2.0], [4.0, 0.0]])
+    filtered = filter_vectors_edge_ragged(z, 3, 1)
+    np.testing.assert_array_equal(filtered, [[0, 1], [-3, 0.5]])
+    np.testing.assert_array_equal(z[2:], [[1, -2], [4, 0]])
+
+
+def test_filter_vectors_edge_ragged_csr(ragged_vectors):
+    flat, offsets = ragged_to_csr(ragged_vectors)
+    filtered, filtered_offsets = filter_vectors_edge_ragged(flat, 3, 1, offsets=offsets)
+    np.testing.assert_array_equal(filtered, [[0.5, 0.5], [-2, 1]])
+    np.testing.assert_array_equal(filtered_offsets, [0, 1, 1, 1, 2])
@@ -16,10 +16,19 @@
 # You should have received a copy of the GNU General Public License
 # along with pyXem.  If not, see <http://www.gnu.org/licenses/>.
 
+import weakref
+
 import numpy as np
 from hyperspy.drawing._markers.point import Point
 from hyperspy.drawing._markers.line_segment import LineSegment
 
+from pyxem.utils.vector_utils import ragged_to_csr
+
+# Marker position arrays of recently used peak arrays, see
+# _get_cached_marker_position_arrays
+_MARKER_CACHE = {}
+_MARKER_CACHE_SIZE = 8
+
 
 def _get_4d_points_marker_list(
     peaks_list,
@@ -28,6 +37,7 @@ def _get_4d_points_marker_list(
     size=20,
     bool_array=None,
     bool_invert=False,
+    cache=False,
 ):
     """Get a list of 4 dimensional point markers.
 
@@ -45,6 +55,10 @@ def _get_4d_points_marker_list(
         Same shape as peaks_list.
     bool_invert : bool, optional
         Default False.
+    cache : bool, optional
+        Reuse the marker positions computed for the same peak array and
+        signal axes calibration. Not used together with bool_array.
+        Default False.
 
     Returns
     -------
@@ -63,46 +77,16 @@ def _get_4d_points_marker_list(
         peaks_list = _filter_peak_array_with_bool_array(
             peaks_list, bool_array, bool_invert=bool_invert
         )
-    max_peaks = 0
-    if peaks_list.dtype == object:
-        peaks_list_shape = peaks_list.shape
+    if cache and bool_array is None:
+        marker_x_array, marker_y_array = _get_cached_marker_position_arrays(
+            peaks_list, signal_axes
+        )
     else:
-        peaks_list_shape = peaks_list.shape[:-2]
-    for index in np.ndindex(peaks_list_shape):
-        islice = np.s_[index]
-        peak_list = peaks_list[islice]
-        if peak_list is not None:
-            n_peaks = len(peak_list)
-            if n_peaks > max_peaks:
-                max_peaks = n_peaks
-
-    marker_array_shape = list(peaks_list_shape)
-    marker_array_shape.append(max_peaks)
-    marker_x_array = np.ones(marker_array_shape) * -1000
-    marker_y_array = np.ones(marker_array_shape) * -1000
-    for index in np.ndindex(peaks_list_shape):
-        islice = np.s_[index]
-        peak_list = peaks_list[islice]
-        if peak_list is not None:
-            for i_p, peak in enumerate(peak_list):
-                i2slice = list(islice)
-                i2slice.append(i_p)
-                i2slice = tuple(i2slice)
-                if signal_axes is None:
-                    marker_x_array[i2slice] = peak[1]
-                    marker_y_array[i2slice] = peak[0]
-                else:
-                    i0min = signal_axes[0].low_index
-                    i0max = signal_axes[0].high_index
-                    i1min = signal_axes[1].low_index
-                    i1max = signal_axes[1].high_index
-                    bool0 = i0min <= peak[1] <= i0max
-                    bool1 = i1min <= peak[0] <= i1max
-                    if bool0 and bool1:
-                        vx = _pixel_to_scaled_value(signal_axes[0], peak[1])
-                        vy = _pixel_to_scaled_value(signal_axes[1], peak[0])
-                        marker_x_array[i2slice] = vx
-                        marker_y_array[i2slice] = vy
+        marker_x_array, marker_y_array = _get_marker_position_arrays(
+            peaks_list, signal_axes
+        )
+    max_peaks = marker_x_array.shape[-1]
+
     marker_list = []
     for i_p in range(max_peaks):
         marker = Point(
@@ -112,6 +96,133 @@ def _get_4d_points_marker_list(
     return marker_list
 
 
+def _get_cached_marker_position_arrays(peaks_list, signal_axes):
+    """Memoized version of _get_marker_position_arrays.
+
+    Results are keyed on the identity and shape of `peaks_list` and on the
+    calibration of the signal axes, so adding markers for the same peak
+    array several times only computes the positions once. The peak array
+    is therefore assumed not to be modified in place in between. An entry
+    is dropped as soon as its peak array is garbage collected.
+
+    """
+    if signal_axes is None:
+        axes_key = None
+    else:
+        axes_key = tuple(
+            (axis.offset, axis.scale, axis.low_index, axis.high_index)
+            for axis in signal_axes[:2]
+        )
+    key = (id(peaks_list), peaks_list.shape, axes_key)
+    cached = _MARKER_CACHE.get(key)
+    # The id of a garbage collected array can be reused by a new one
+    if cached is not None and cached[0]() is peaks_list:
+        return cached[1].copy(), cached[2].copy()
+
+    marker_x_array, marker_y_array = _get_marker_position_arrays(
+        peaks_list, signal_axes
+    )
+    if len(_MARKER_CACHE) >= _MARKER_CACHE_SIZE:
+        del _MARKER_CACHE[next(iter(_MARKER_CACHE))]
+    _MARKER_CACHE[key] = (
+        weakref.ref(peaks_list, _remove_cache_entry_callback(key)),
+        marker_x_array.copy(),
+        marker_y_array.copy(),
+    )
+    return marker_x_array, marker_y_array
+
+
+def _remove_cache_entry_callback(key):
+    def remove(ref):
+        # The entry may already have been evicted and replaced by one for a
+        # new array with the same id
+        cached = _MARKER_CACHE.get(key)
+        if cached is not None and cached[0] is ref:
+            del _MARKER_CACHE[key]
+
+    return remove
+
+
+def _get_marker_position_arrays(peaks_list, signal_axes=None):
+    """Get the x and y marker positions of every peak in a peak array.
+
+    Parameters
+    ----------
+    peaks_list : NumPy array
+    signal_axes : HyperSpy axes_manager object, optional
+
+    Returns
+    -------
+    marker_x_array, marker_y_array : NumPy arrays
+        With the navigation shape of peaks_list, and the maximum number of
+        peaks as the last dimension. Missing peaks, and peaks outside
+        the signal axes, are set to -1000.
+
+    """
+    if peaks_list.dtype == object:
+        peaks_list_shape = peaks_list.shape
+    else:
+        peaks_list_shape = peaks_list.shape[:-2]
+    peaks_flat, offsets = _peak_array_to_csr(peaks_list)
+    n_peaks = np.diff(offsets)
+    n_cells = n_peaks.size
+    max_peaks = int(n_peaks.max()) if n_cells > 0 else 0
+
+    # Position of every peak in the (cell, peak) marker grid
+    cell_index = np.repeat(np.arange(n_cells), n_peaks)
+    peak_index = np.arange(len(peaks_flat)) - np.repeat(offsets[:-1], n_peaks)
+
+    rows, cols = peaks_flat[:, 0], peaks_flat[:, 1]
+    if signal_axes is None:
+        inside = np.ones(len(peaks_flat), dtype=bool)
+        marker_x, marker_y = cols, rows
+    else:
+        sa0, sa1 = signal_axes[0], signal_axes[1]
+        inside = (sa0.low_index <= cols) & (cols <= sa0.high_index)
+        inside &= (sa1.low_index <= rows) & (rows <= sa1.high_index)
+        marker_x = _pixel_to_scaled_value(sa0, cols)
+        marker_y = _pixel_to_scaled_value(sa1, rows)
+
+    marker_x_array = np.full((n_cells, max_peaks), -1000.0)
+    marker_y_array = np.full((n_cells, max_peaks), -1000.0)
+    cell_index, peak_index = cell_index[inside], peak_index[inside]
+    marker_x_array[cell_index, peak_index] = marker_x[inside]
+    marker_y_array[cell_index, peak_index] = marker_y[inside]
+    marker_array_shape = tuple(peaks_list_shape) + (max_peaks,)
+    marker_x_array = marker_x_array.reshape(marker_array_shape)
+    marker_y_array = marker_y_array.reshape(marker_array_shape)
+
+    return marker_x_array, marker_y_array
+
+
+def _peak_array_to_csr(peaks_list):
+    """Stack the peaks of every navigation position into a single array.
+
+    Parameters
+    ----------
+    peaks_list : NumPy array
+        Either a ragged object array, where each element is a list of
+        [y, x] peak positions or None, or a regular array with the peak
+        positions in the last two dimensions.
+
+    Returns
+    -------
+    peaks_flat : NumPy array
+        All the peak positions, with shape (total number of peaks, 2).
+    offsets : NumPy array
+        The peaks of the i-th flattened navigation position are
+        peaks_flat[offsets[i]:offsets[i + 1]].
+
+    """
+    if peaks_list.dtype == object:
+        peaks_flat, offsets = ragged_to_csr(peaks_list)
+    else:
+        n_cells = int(np.prod(peaks_list.shape[:-2]))
+        offsets = np.arange(n_cells + 1) * peaks_list.shape[-2]
+        peaks_flat = peaks_list.reshape(-1, peaks_list.shape[-1]).astype(float)
+    return peaks_flat[:, :2], offsets
+
+
 def _pixel_to_scaled_value(axis, pixel_value):
     offset = axis.offset
     scale = axis.scale
@@ -159,36 +270,49 @@ def _get_4d_line_segment_list(
     marker_list : list of HyperSpy marker objects
 
     """
-    max_lines = 0
-    for ix, iy in np.ndindex(lines_array.shape[:2]):
-        lines_list = lines_array[ix, iy]
-        if lines_list is not None:
-            n_lines = len(lines_list)
-            if n_lines > max_lines:
-                max_lines = n_lines
+    if lines_array.dtype != object:
+        n_lines = np.full(lines_array.shape[:2], lines_array.shape[2])
+    else:
+        n_lines = np.frompyfunc(_len_or_zero, 1, 1)(lines_array).astype(int)
+    max_lines = int(n_lines.max()) if n_lines.size > 0 else 0
 
     marker_array_shape = (lines_array.shape[0], lines_array.shape[1], max_lines)
     marker_x1_array = np.ones(marker_array_shape) * -1000
     marker_y1_array = np.ones(marker_array_shape) * -1000
     marker_x2_array = np.ones(marker_array_shape) * -1000
     marker_y2_array = np.ones(marker_array_shape) * -1000
-    for ix, iy in np.ndindex(marker_x1_array.shape[:2]):
+    if signal_axes is not None:
+        sa0, sa1 = signal_axes[0], signal_axes[1]
+        # Non-uniform axes have no scale and offset
+        uniform = sa0.is_uniform and sa1.is_uniform
+        if uniform:
+            scale0, offset0 = sa0.scale, sa0.offset
+            scale1, offset1 = sa1.scale, sa1.offset
+    for ix, iy in zip(*np.nonzero(n_lines)):
         lines_list = lines_array[ix, iy]
-        if lines_list is not None:
-            for i_p, line in enumerate(lines_list):
-                if signal_axes is None:
-                    marker_x1_array[ix, iy, i_p] = line[1]
-                    marker_y1_array[ix, iy, i_p] = line[0]
-                    marker_x2_array[ix, iy, i_p] = line[3]
-                    marker_y2_array[ix, iy, i_p] = line[2]
+        for i_p, line in enumerate(lines_list):
+            if signal_axes is None:
+                marker_x1_array[ix, iy, i_p] = line[1]
+                marker_y1_array[ix, iy, i_p] = line[0]
+                marker_x2_array[ix, iy, i_p] = line[3]
+                marker_y2_array[ix, iy, i_p] = line[2]
+            else:
+                if not _check_line_segment_inside(signal_axes, line):
+                    continue
+                if uniform:
+                    x1 = offset0 + scale0 * int(line[1])
+                    y1 = offset1 + scale1 * int(line[0])
+                    x2 = offset0 + scale0 * int(line[3])
+                    y2 = offset1 + scale1 * int(line[2])
                 else:
-                    if _check_line_segment_inside(signal_axes, line):
-                        sa0iv = signal_axes[0].index2value
-                        sa1iv = signal_axes[1].index2value
-                        marker_x1_array[ix, iy, i_p] = sa0iv(int(line[1]))
-                        marker_y1_array[ix, iy, i_p] = sa1iv(int(line[0]))
-                        marker_x2_array[ix, iy, i_p] = sa0iv(int(line[3]))
-                        marker_y2_array[ix, iy, i_p] = sa1iv(int(line[2]))
+                    x1 = sa0.index2value(int(line[1]))
+                    y1 = sa1.index2value(int(line[0]))
+                    x2 = sa0.index2value(int(line[3]))
+                    y2 = sa1.index2value(int(line[2]))
+                marker_x1_array[ix, iy, i_p] = x1
+                marker_y1_array[ix, iy, i_p] = y1
+                marker_x2_array[ix, iy, i_p] = x2
+                marker_y2_array[ix, iy, i_p] = y2
 
     marker_list = []
     for i_p in range(max_lines):
@@ -205,6 +329,10 @@ def _get_4d_line_segment_list(
     return marker_list
 
 
+def _len_or_zero(item):
+    return 0 if item is None else len(item)
+
+
 def _check_line_segment_inside(signal_axes, line):
     sa0_li = signal_axes[0].low_index
     sa0_hi = signal_axes[0].high_index
@@ -251,13 +379,21 @@ def _add_permanent_markers_to_signal(signal, marker_list):
     if not hasattr(signal.metadata, "Markers"):
         signal.metadata.add_node("Markers")
     marker_extra = len(signal.metadata.Markers)
-    for imarker, marker in enumerate(marker_list):
-        marker_name = "marker{0}".format(imarker + marker_extra)
-        signal.metadata.Markers[marker_name] = marker
+    marker_dict = {
+        "marker{0}".format(imarker + marker_extra): marker
+        for imarker, marker in enumerate(marker_list)
+    }
+    signal.metadata.Markers.add_dictionary(marker_dict)
 
 
 def add_peak_array_to_signal_as_markers(
-    signal, peak_array, color="red", size=20, bool_array=None, bool_invert=False
+    signal,
+    peak_array,
+    color="red",
+    size=20,
+    bool_array=None,
+    bool_invert=False,
+    cache=False,
 ):
     """Add an array of points to a signal as HyperSpy markers.
 
@@ -273,6 +409,11 @@ def add_peak_array_to_signal_as_markers(
         Same shape as peaks_list.
     bool_invert : bool, optional
         Default False.
+    cache : bool, optional
+        If True, the marker positions are cached for the most recently used
+        peak arrays, which speeds up adding markers for the same peak array
+        to several signals. peak_array must then not be modified in place
+        in between. Default False.
 
     Example
     -------
@@ -295,5 +436,6 @@ def add_peak_array_to_signal_as_markers(
         size=size,
         bool_array=bool_array,
         bool_invert=bool_invert,
+        cache=cache,
     )
     _add_permanent_markers_to_signal(signal, marker_list)
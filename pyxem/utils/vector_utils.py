@@ -18,8 +18,9 @@
 
 import numpy as np
 import math
+from numba import njit
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
-from transforms3d.axangles import axangle2mat
 
 
 def detector_to_fourier(k_xy, wavelength, camera_length):
@@ -54,10 +55,13 @@ def detector_to_fourier(k_xy, wavelength, camera_length):
     # the wavelength. k_z is calculated courtesy of Pythagoras, then offset by
     # the Ewald sphere radius.
 
-    k_z = np.sqrt(1 / (wavelength**2) - np.sum(k_xy**2, axis=1)) - 1 / wavelength
+    k_xy_squared = np.einsum("ij,ij->i", k_xy, k_xy)
+    k_z = np.sqrt(1 / (wavelength * wavelength) - k_xy_squared) - 1 / wavelength
 
-    # Stack the xy-vector and the z vector to get the full k
-    k = np.hstack((k_xy, k_z[:, np.newaxis]))
+    # Fill the xy-vector and the z vector into the full k
+    k = np.empty((k_xy.shape[0], 3), dtype=np.result_type(k_xy, k_z))
+    k[:, :2] = k_xy
+    k[:, 2] = k_z
     return k
 
 
@@ -72,9 +76,14 @@ def calculate_norms(z):
     Returns
     -------
     norms : np.array()
-        Array of vector norms.
+        Array of vector norms, with the same floating point type as `z`.
     """
-    return np.linalg.norm(z, axis=1)
+    z = np.asarray(z)
+    if not np.issubdtype(z.dtype, np.floating):
+        z = z.astype(float)
+    norms = np.einsum("ij,ij->i", z, z)
+    np.sqrt(norms, out=norms)
+    return norms
 
 
 def calculate_norms_ragged(z):
@@ -91,61 +100,162 @@ def calculate_norms_ragged(z):
     norms : np.array()
         Array of vector norms.
     """
-    norms = []
-    for i in z:
-        norms.append(np.linalg.norm(i))
-    return np.asarray(norms)
+    if isinstance(z, np.ndarray) and z.dtype != object:
+        z = z.reshape(z.shape[0], int(np.prod(z.shape[1:])))
+        return np.sqrt(np.einsum("ij,ij->i", z, z))
+    # Ragged input: sum the squares of all the sub-arrays in one flat pass
+    arrays = [np.ravel(i) for i in z]
+    lengths = np.fromiter((len(i) for i in arrays), dtype=int, count=len(arrays))
+    if lengths.sum() == 0:
+        return np.zeros(len(arrays))
+    flat = np.concatenate(arrays).astype(float)
+    labels = np.repeat(np.arange(len(arrays)), lengths)
+    squares = np.bincount(labels, weights=flat * flat, minlength=len(arrays))
+    return np.sqrt(squares)
+
+
+def ragged_to_csr(vectors):
+    """Converts a ragged array of vectors to a single flat array of vectors
+    and an array of offsets into it.
+
+    Parameters
+    ----------
+    vectors : np.array()
+        Object array where each element is an array of vectors, or None.
+
+    Returns
+    -------
+    flat : np.array()
+        All the vectors, in the order of the flattened `vectors`.
+    offsets : np.array()
+        The vectors of the i-th element of the flattened `vectors` are
+        ``flat[offsets[i]:offsets[i + 1]]``.
+
+    See Also
+    --------
+    csr_to_ragged
+    """
+    arrays = [
+        [] if v is None else np.asarray(v, dtype=float) for v in np.ravel(vectors)
+    ]
+    offsets = np.zeros(len(arrays) + 1, dtype=int)
+    offsets[1:] = np.cumsum([len(v) for v in arrays])
+    non_empty = [v for v in arrays if len(v) > 0]
+    if len(non_empty) == 0:
+        # Keep the vector length of the input, if any element gives it
+        widths = [np.shape(v)[-1] for v in arrays if np.ndim(v) == 2]
+        return np.empty((0, widths[0] if widths else 2)), offsets
+    return np.concatenate(non_empty), offsets
+
+
+def csr_to_ragged(flat, offsets, shape=None):
+    """Converts a flat array of vectors and an array of offsets into it, as
+    returned by :func:`ragged_to_csr`, back to a ragged array.
 
+    Parameters
+    ----------
+    flat : np.array()
+        All the vectors.
+    offsets : np.array()
+        Offsets of the vectors of each element into `flat`.
+    shape : tuple, optional
+        Shape of the returned array. Default is one dimensional.
 
-def filter_vectors_ragged(z, min_magnitude, max_magnitude):
+    Returns
+    -------
+    vectors : np.array()
+        Object array where each element is an array of vectors. The
+        elements are views into `flat`, not copies, so writing to them
+        also changes `flat`.
+    """
+    vectors = np.empty(len(offsets) - 1, dtype=object)
+    for i in range(len(vectors)):
+        vectors[i] = flat[offsets[i] : offsets[i + 1]]
+    if shape is not None:
+        vectors = vectors.reshape(shape)
+    return vectors
+
+
+def _filter_csr(flat, offsets, keep):
+    """Keeps the rows of `flat` where `keep` is True and updates `offsets`."""
+    kept_before = np.zeros(len(keep) + 1, dtype=int)
+    np.cumsum(keep, out=kept_before[1:])
+    return flat[keep], kept_before[offsets]
+
+
+def filter_vectors_ragged(z, min_magnitude, max_magnitude, offsets=None):
     """Filters the diffraction vectors to accept only those with magnitudes
     within a user specified range.
 
     Parameters
     ----------
+    z : np.array()
+        Array of cartesian vectors.
     min_magnitude : float
         Minimum allowed vector magnitude.
     max_magnitude : float
         Maximum allowed vector magnitude.
+    offsets : np.array(), optional
+        If given, `z` holds the vectors of several navigation positions in
+        the flat layout of :func:`ragged_to_csr`, and these are filtered
+        in a single pass.
 
     Returns
     -------
     filtered_vectors : np.array()
         Diffraction vectors within allowed magnitude tolerances.
+    filtered_offsets : np.array()
+        Offsets into `filtered_vectors`. Only returned if `offsets` is given.
     """
-    # Calculate norms
-    norms = []
-    for i in z:
-        norms.append(np.linalg.norm(i))
-    norms = np.asarray(norms)
-    # Filter based on norms
-    norms[norms < min_magnitude] = 0
-    norms[norms > max_magnitude] = 0
-    filtered_vectors = z[np.where(norms)]
+    z = np.asarray(z)
+    if z.size == 0:
+        return z if offsets is None else (z, offsets.copy())
+    # Compare squared magnitudes, avoiding the square root. A negative lower
+    # bound is clamped to 0 first, as squaring would flip its sign
+    squared = np.einsum("ij,ij->i", z, z)
+    min_magnitude = max(min_magnitude, 0)
+    keep = squared >= min_magnitude * min_magnitude
+    keep &= squared <= max_magnitude * max_magnitude
+    if max_magnitude < 0:
+        keep[:] = False
+    if offsets is not None:
+        return _filter_csr(z, offsets, keep)
+    filtered_vectors = z[keep]
 
     return filtered_vectors
 
 
-def filter_vectors_edge_ragged(z, x_threshold, y_threshold):
+def filter_vectors_edge_ragged(z, x_threshold, y_threshold, offsets=None):
     """Filters the diffraction vectors to accept only those not within a user
     specified proximity to detector edge.
 
     Parameters
     ----------
+    z : np.array()
+        Array of cartesian vectors.
     x_threshold : float
         Maximum x-coordinate in calibrated units.
     y_threshold : float
         Maximum y-coordinate in calibrated units.
+    offsets : np.array(), optional
+        If given, `z` holds the vectors of several navigation positions in
+        the flat layout of :func:`ragged_to_csr`, and these are filtered
+        in a single pass.
 
     Returns
     -------
     filtered_vectors : np.array()
         Diffraction vectors within allowed tolerances.
+    filtered_offsets : np.array()
+        Offsets into `filtered_vectors`. Only returned if `offsets` is given.
     """
+    z = np.asarray(z)
     # Filter x / y coordinates
-    z[np.absolute(z.T[0]) > x_threshold] = 0
-    z[np.absolute(z.T[1]) > y_threshold] = 0
-    filtered_vectors = z[np.where(z.T[0])]
+    keep = np.absolute(z[:, 0]) <= x_threshold
+    keep &= np.absolute(z[:, 1]) <= y_threshold
+    if offsets is not None:
+        return _filter_csr(z, offsets, keep)
+    filtered_vectors = z[keep]
 
     return filtered_vectors
 
@@ -158,10 +268,45 @@ def normalize_or_zero(v):
     v : np.array()
         Single vector or array of vectors to be normalized.
     """
-    norms = np.linalg.norm(v, axis=-1)
-    nonzero_mask = norms > 0
-    if np.any(nonzero_mask):
-        v[nonzero_mask] /= norms[nonzero_mask].reshape(-1, 1)
+    norms = np.asarray(np.linalg.norm(v, axis=-1))
+    # Zero length vectors are multiplied by 1, i.e. left unchanged
+    inverse_norms = np.ones_like(norms)
+    np.reciprocal(norms, out=inverse_norms, where=norms > 0)
+    np.multiply(v, inverse_norms[..., np.newaxis], out=v)
+
+
+@njit(nogil=True, cache=True)
+def _axangle_batch_kernel(axes, angles, out):
+    """Fill `out` with the rotation matrices for normalized `axes` and
+    `angles`, using Rodrigues' rotation formula. Equivalent to
+    `transforms3d.axangles.axangle2mat` with `is_normalized=True` for each
+    row, without the normalization check.
+
+    Parameters
+    ----------
+    axes : np.array()
+        Nx3 array of unit rotation axes.
+    angles : np.array()
+        N rotation angles in radians.
+    out : np.array()
+        Nx3x3 array to write the rotation matrices to.
+    """
+    for i in range(axes.shape[0]):
+        x, y, z = axes[i, 0], axes[i, 1], axes[i, 2]
+        c = math.cos(angles[i])
+        s = math.sin(angles[i])
+        C = 1.0 - c
+        xs, ys, zs = x * s, y * s, z * s
+        xyC, yzC, zxC = x * y * C, y * z * C, z * x * C
+        out[i, 0, 0] = x * x * C + c
+        out[i, 0, 1] = xyC - zs
+        out[i, 0, 2] = zxC + ys
+        out[i, 1, 0] = xyC + zs
+        out[i, 1, 1] = y * y * C + c
+        out[i, 1, 2] = yzC - xs
+        out[i, 2, 0] = zxC - ys
+        out[i, 2, 1] = yzC + xs
+        out[i, 2, 2] = z * z * C + c
 
 
 def get_rotation_matrix_between_vectors(from_v1, from_v2, to_v1, to_v2):
@@ -204,15 +349,7 @@ def get_rotation_matrix_between_vectors(from_v1, from_v2, to_v1, to_v2):
         np.broadcast_to(plane_normal_from, plane_normal_to.shape), plane_normal_to
     )
     R1 = np.empty((angles.shape[0], 3, 3))
-    if np.any(common_valid):
-        R1[common_valid] = np.array(
-            [
-                axangle2mat(axis, angle, is_normalized=True)
-                for axis, angle in zip(
-                    plane_common_axes[common_valid], angles[common_valid]
-                )
-            ]
-        )
+    _axangle_batch_kernel(plane_common_axes, angles, R1)
     R1[~common_valid] = np.identity(3)
 
     # Rotate from-plane into to-plane
@@ -221,26 +358,21 @@ def get_rotation_matrix_between_vectors(from_v1, from_v2, to_v1, to_v2):
 
     # Create rotation in the now common plane
 
-    # Find the average angle
-    angle1 = get_angle_cartesian_vec(rot_from_v1, to_v1)
-    angle2 = get_angle_cartesian_vec(rot_from_v2, to_v2)
-    angles = 0.5 * (angle1 + angle2)
-    # Negate angles where the rotation where the rotation axis points the
-    # opposite way of the to-plane normal. Einsum gives list of dot
-    # products.
-    neg_angle_mask = (
-        np.einsum("ij,ij->i", np.cross(rot_from_v1, to_v1, axis=-1), plane_normal_to)
-        < 0
+    # Find the average angle, negated where the rotation axis points the
+    # opposite way of the to-plane normal
+    angles = np.empty(rot_from_v1.shape[0])
+    _get_average_signed_angle_kernel(
+        rot_from_v1,
+        rot_from_v2,
+        np.asarray(to_v1, dtype=float),
+        np.asarray(to_v2, dtype=float),
+        plane_normal_to,
+        angles,
     )
-    np.negative(angles, out=angles, where=neg_angle_mask)
 
     # To-plane normal still the same
-    R2 = np.array(
-        [
-            axangle2mat(axis, angle, is_normalized=True)
-            for axis, angle in zip(plane_normal_to, angles)
-        ]
-    )
+    R2 = np.empty_like(R1)
+    _axangle_batch_kernel(plane_normal_to, angles, R2)
 
     # Total rotation is the combination of to plane R1 and in plane R2
     R = np.matmul(R2, R1)
@@ -284,19 +416,63 @@ def get_angle_cartesian_vec(a, b):
             "The shape of a {} and b {} must be the same.".format(a.shape, b.shape)
         )
 
-    denom = np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1)
-    denom_nonzero = denom != 0.0
-    angles = np.zeros(a.shape[0])
-    angles[denom_nonzero] = np.arccos(
-        np.clip(
-            np.sum(a[denom_nonzero] * b[denom_nonzero], axis=-1) / denom[denom_nonzero],
-            -1.0,
-            1.0,
-        )
-    ).ravel()
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    angles = np.empty(a.shape[0])
+    _get_angle_cartesian_vec_kernel(a, b, angles)
     return angles
 
 
+@njit(nogil=True, cache=True)
+def _get_angle_cartesian_kernel(a, b):
+    """Angle between the vectors `a` and `b`, 0 if either has zero length.
+
+    The dot product and both norms are computed in a single pass.
+    """
+    ab = 0.0
+    aa = 0.0
+    bb = 0.0
+    for k in range(a.shape[0]):
+        ab += a[k] * b[k]
+        aa += a[k] * a[k]
+        bb += b[k] * b[k]
+    denom = math.sqrt(aa) * math.sqrt(bb)
+    if denom == 0.0:
+        return 0.0
+    return math.acos(max(-1.0, min(1.0, ab / denom)))
+
+
+@njit(nogil=True, cache=True)
+def _get_angle_cartesian_vec_kernel(a, b, out):
+    """Fill `out` with the angles between the rows of `a` and `b`.
+
+    Serial, as it is called for a handful of vectors per probe position from
+    within the threaded `map` of `match_vectors`.
+    """
+    for i in range(a.shape[0]):
+        out[i] = _get_angle_cartesian_kernel(a[i], b[i])
+
+
+@njit(nogil=True, cache=True)
+def _get_average_signed_angle_kernel(from_v1, from_v2, to_v1, to_v2, normal, out):
+    """Fill `out` with the mean of the angles from `from_v1` to `to_v1` and
+    from `from_v2` to `to_v2`, negated where `from_v1` x `to_v1` points away
+    from `normal`. All arguments are Nx3 arrays, except `out` of length N.
+    """
+    for i in range(from_v1.shape[0]):
+        angle1 = _get_angle_cartesian_kernel(from_v1[i], to_v1[i])
+        angle2 = _get_angle_cartesian_kernel(from_v2[i], to_v2[i])
+        a, b, n = from_v1[i], to_v1[i], normal[i]
+        # Triple product, (a x b) . n
+        triple = (
+            (a[1] * b[2] - a[2] * b[1]) * n[0]
+            + (a[2] * b[0] - a[0] * b[2]) * n[1]
+            + (a[0] * b[1] - a[1] * b[0]) * n[2]
+        )
+        angle = 0.5 * (angle1 + angle2)
+        out[i] = -angle if triple < 0 else angle
+
+
 def get_angle_cartesian(a, b):
     """Compute the angle between two vectors in a cartesian coordinate system.
 
@@ -310,10 +486,20 @@ def get_angle_cartesian(a, b):
     angle : float
         Angle between `a` and `b` in radians.
     """
-    denom = np.linalg.norm(a) * np.linalg.norm(b)
+    if len(a) == 3 and len(b) == 3:
+        # Plain scalar arithmetic is much faster than NumPy calls for a
+        # single pair of 3-vectors
+        ax, ay, az = np.asarray(a, dtype=float).tolist()
+        bx, by, bz = np.asarray(b, dtype=float).tolist()
+        denom = math.sqrt(ax * ax + ay * ay + az * az)
+        denom *= math.sqrt(bx * bx + by * by + bz * bz)
+        dot = ax * bx + ay * by + az * bz
+    else:
+        denom = np.linalg.norm(a) * np.linalg.norm(b)
+        dot = np.dot(a, b)
     if denom == 0:
         return 0.0
-    return math.acos(max(-1.0, min(1.0, np.dot(a, b) / denom)))
+    return math.acos(max(-1.0, min(1.0, dot / denom)))
 
 
 def filter_vectors_near_basis(vectors, basis, distance=None):
@@ -337,12 +523,20 @@ def filter_vectors_near_basis(vectors, basis, distance=None):
         An array of vectors which are the closest to the basis considered.
     """
     if len(vectors) == 0:
-        vectors = np.empty(basis.shape)
-        vectors[:, :] = np.nan
-        return vectors
-    distance_mat = cdist(vectors, basis)
-    closest_index = np.argmin(distance_mat, axis=0)
-    min_distance = distance_mat[closest_index, np.arange(len(basis), dtype=int)]
+        return np.full(basis.shape, np.nan)
+    if len(vectors) * len(basis) < 4096:
+        # The full distance matrix is cheap for small inputs
+        distance_mat = cdist(vectors, basis)
+        closest_index = np.argmin(distance_mat, axis=0)
+        min_distance = distance_mat[closest_index, np.arange(len(basis), dtype=int)]
+    else:
+        upper_bound = np.inf if distance is None else np.nextafter(distance, np.inf)
+        min_distance, closest_index = cKDTree(vectors).query(
+            basis, k=1, distance_upper_bound=upper_bound
+        )
+        # No neighbour within the bound gives an index of len(vectors) and an
+        # infinite distance, which is masked below
+        closest_index = np.minimum(closest_index, len(vectors) - 1)
     closest_vectors = vectors[closest_index]
     if distance is not None:
         if closest_vectors.dtype == int: